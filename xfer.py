@@ -7,18 +7,39 @@ on an execution point.
 
 import abc
 import argparse
+import concurrent.futures
 import contextlib
 import enum
+import functools
 import hashlib
 import json
 import logging
 import os
-import re
+import queue
+import reprlib
 import shutil
 import sys
+import threading
 import time
 from pathlib import Path
-from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Type, TypeVar
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+)
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the standard library
+    orjson = None  # type: ignore
 
 T_JSON = Dict[str, Any]
 T_CMD_INFO = List[Mapping[str, Path]]
@@ -30,22 +51,62 @@ TB = 2**40
 
 METADATA_FILE_SIZE_LIMIT = 16 * KB
 
+# Size of the chunks that files are read, hashed, and copied in.
+IO_CHUNK_SIZE = 8 * MB
+
+# Number of read-ahead buffers shared between a reader thread and its consumer.
+READ_AHEAD_BUFFERS = 4
+
+# Buffer size for files that manifest entries are written to in bulk.
+MANIFEST_BUFFER_SIZE = MB
+
+# Number of threads used to list directories in parallel.
+WALK_WORKERS = 8
+
+# Number of threads used to stat files in parallel.
+STAT_WORKERS = 32
+
+# Bytes from the start of the transfer manifest, and from just before where the last
+# analysis stopped, that identify the manifest that analysis belongs to.
+ANALYZE_FINGERPRINT_SIZE = 4 * KB
+
+# Entries written before digests were tagged with their algorithm used SHA-1.
+LEGACY_HASH_ALGORITHM = "sha1"
+HASH_ALGORITHM = "blake2b"
+HASH_ALGORITHMS = {
+    "sha1": hashlib.sha1,
+    "blake2b": hashlib.blake2b,
+}
+
 SANDBOX_FILE_NAME = "file-for-transfer"
 REQUIREMENTS_FILE_NAME = "requirements.txt"
 METADATA_FILE_NAME = "metadata"
 LOCAL_MANIFEST_FILE_NAME = "local_manifest.txt"
 REMOTE_MANIFEST_FILE_NAME = "remote_manifest.txt"
 TRANSFER_MANIFEST_FILE_NAME = "transfer_manifest.txt"
+ANALYZE_STATE_SUFFIX = ".analyze_state.json"
 TRANSFER_COMMANDS_FILE_NAME = "transfer_commands.json"
 VERIFY_COMMANDS_FILE_NAME = "verify_commands.json"
 DRY_RUN_OUTPUT_FILE_NAME = "dry_run.json"
 
+# Sync request counters that must all be empty or zero once the sync is done.
+WORK_REMAINING_KEYS = (
+    "files_to_verify",
+    "bytes_to_verify",
+    "files",
+    "files_to_transfer",
+    "bytes_to_transfer",
+)
+
 OUTER_DAG_NAME = "outer.dag"
 INNER_DAG_NAME = "inner.dag"
 DAG_ARGS = {"force": True}
 
 THIS_FILE = Path(__file__).resolve()
 
+# The job environment does not change while we run
+IS_CONDOR_JOB = "_CONDOR_JOB_AD" in os.environ
+
 
 class TransferError(Exception):
     pass
@@ -90,6 +151,9 @@ class Commands(StrEnum):
     FINALIZE_TRANSFER_MANIFEST = "finalize_transfer_manifest"
 
 
+COMMANDS_BY_NAME = {command.value: command for command in Commands}
+
+
 class TransferDirection(StrEnum):
     PULL = "pull"
     PUSH = "push"
@@ -109,6 +173,7 @@ def write_requirements_file(working_dir: Path, requirements: str) -> None:
     (working_dir / REQUIREMENTS_FILE_NAME).write_text(requirements)
 
 
+@functools.lru_cache(maxsize=4)
 def read_requirements_file(requirements_file: Optional[Path]) -> Optional[str]:
     if requirements_file is None:
         return None
@@ -116,14 +181,37 @@ def read_requirements_file(requirements_file: Optional[Path]) -> Optional[str]:
     return requirements_file.read_text().strip()
 
 
-RE_SPLIT_CAMEL = re.compile(r".+?(?:(?<=[a-z])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])|$)")
+def short_repr(obj: Any, max_items: int = 50) -> str:
+    # Large syncs can leave thousands of files behind; only show a sample of them
+    r = reprlib.Repr()
+    r.maxdict = r.maxlist = r.maxset = max_items
+    r.maxstring = r.maxother = 200
+    return r.repr(obj)
 
 
 def camel_to_upper_snake(text: str) -> str:
-    return "_".join(m.group(0).upper() for m in RE_SPLIT_CAMEL.finditer(text))
+    # Words start at a lower-to-upper case change (SyncDone -> SYNC_DONE) or
+    # at the last capital of an acronym (HTTPServer -> HTTP_SERVER).
+    chars = []
+    for i, c in enumerate(text):
+        if i > 0 and c.isupper():
+            prev = text[i - 1]
+            if prev.islower() or (prev.isupper() and text[i + 1 : i + 2].islower()):
+                chars.append("_")
+        chars.append(c.upper())
+
+    return "".join(chars)
 
 
 class ManifestEntry(metaclass=abc.ABCMeta):
+    # The entry type written in front of each manifest line, e.g. SYNC_DONE.
+    type: str
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        cls.type = camel_to_upper_snake(cls.__name__)
+
     def __init__(self, **info):
         expected_keys = set(self.keys)
 
@@ -156,7 +244,7 @@ class ManifestEntry(metaclass=abc.ABCMeta):
         )
 
     def __str__(self):
-        return "{} {}".format(self.type, json.dumps(self.to_json()))
+        return "{} {}".format(self.type, json_dumps(self.to_json()))
 
     def to_json(self) -> T_JSON:
         return path_values_to_strings(self._info)
@@ -167,10 +255,6 @@ class ManifestEntry(metaclass=abc.ABCMeta):
     def write_entry_to(self, file):
         file.write(self.to_entry())
 
-    @property
-    def type(self) -> str:
-        return camel_to_upper_snake(type(self).__name__)
-
     @property
     @abc.abstractmethod
     def keys(self) -> Tuple[str, ...]:
@@ -204,6 +288,10 @@ class Digest(Name, Size, metaclass=abc.ABCMeta):
     def digest(self):
         return self._info["digest"]
 
+    @property
+    def algorithm(self) -> str:
+        return self._info.get("algorithm", LEGACY_HASH_ALGORITHM)
+
 
 class Timestamp(ManifestEntry, metaclass=abc.ABCMeta):
     def __init__(self, **info):
@@ -227,6 +315,19 @@ class VerifyRequest(Name, Size):
 class TransferComplete(Digest, Timestamp):
     keys = ("name", "size", "digest", "timestamp")
 
+    @property
+    def mtime(self) -> Optional[float]:
+        return self._info.get("mtime")
+
+
+class TransferCompleteV2(TransferComplete):
+    keys = TransferComplete.keys + ("algorithm", "mtime")
+
+    def __init__(self, **info):
+        super().__init__(**info)
+
+        self._info["mtime"] = float(self._info["mtime"])
+
 
 class SyncRequest(Timestamp):
     keys = (
@@ -259,105 +360,183 @@ class SyncDone(Timestamp):
     keys = ("timestamp",)
 
 
-class File(Name, Size):
+class File(Size):
     keys = ("name", "size")
 
+    # File manifests can list millions of files, so names are kept as plain
+    # strings rather than being turned into Paths.
+    @property
+    def name(self) -> str:
+        return self._info["name"]
+
 
 class Metadata(Digest):
     keys = ("name", "size", "digest")
 
 
+class MetadataV2(Metadata):
+    keys = Metadata.keys + ("algorithm",)
+
+
 def descendants(cls):
     for c in cls.__subclasses__():
         yield c
         yield from descendants(c)
 
 
-ENTRY_TYPE_TO_CLASS = {
-    camel_to_upper_snake(cls.__name__): cls for cls in descendants(ManifestEntry)
-}
+ENTRY_TYPE_TO_CLASS = {cls.type: cls for cls in descendants(ManifestEntry)}
 
 
 def read_manifest(path: Path) -> Iterator[Tuple[ManifestEntry, int]]:
-    with path.open(mode="r", encoding="utf-8") as f:
-        for line_number, line in enumerate(f, start=1):
-            line = line.strip()
+    return parse_manifest_lines(path, path.read_bytes(), parse_manifest_entry)
 
-            if not line or line.startswith("#"):
-                continue
 
-            try:
-                yield parse_manifest_entry(line), line_number
-            except Exception:
-                logging.exception(
-                    'Failed to parse manifest entry at {}:{} ("{}")'.format(path, line_number, line)
+def read_manifest_info(path: Path) -> Iterator[Tuple[Tuple[str, T_JSON], int]]:
+    # Like read_manifest, but yields raw (type, info) pairs for callers that go
+    # through very many entries and need only a field or two from each.
+    return parse_manifest_lines(path, path.read_bytes(), parse_manifest_info)
+
+
+def parse_manifest_lines(
+    path: Path, data: bytes, parse: Callable[[bytes], Any], first_line_number: int = 1
+) -> Iterator[Tuple[Any, int]]:
+    # Reading the whole manifest at once and splitting it is much cheaper than
+    # iterating over a text-mode file line by line.
+    for line_number, line in enumerate(data.split(b"\n"), start=first_line_number):
+        line = line.strip()
+
+        if not line or line.startswith(b"#"):
+            continue
+
+        try:
+            yield parse(line), line_number
+        except Exception:
+            logging.exception(
+                'Failed to parse manifest entry at {}:{} ("{}")'.format(
+                    path, line_number, line.decode("utf-8", errors="replace")
                 )
-                raise
+            )
+            raise
 
 
-def parse_manifest_entry(entry: str) -> ManifestEntry:
-    entry = entry.strip()
-    type, info = entry.split(maxsplit=1)
+def parse_manifest_entry(entry: bytes) -> ManifestEntry:
+    type, info = parse_manifest_info(entry)
 
     cls = ENTRY_TYPE_TO_CLASS[type]
-    info = json.loads(info)
 
     return cls(**info)
 
 
+def parse_manifest_info(entry: bytes) -> Tuple[str, T_JSON]:
+    type, info = entry.split(maxsplit=1)
+
+    return type.decode("utf-8"), json_loads(info)
+
+
 def create_file_manifest(root_path: Path, manifest_path: Path, test_mode: bool = False) -> None:
     logging.info("Generating file listing for %s", root_path)
 
-    with manifest_path.open(mode="w", encoding="utf-8") as f:
+    with manifest_path.open(mode="w", encoding="utf-8", buffering=MANIFEST_BUFFER_SIZE) as f:
         if not root_path.exists():
             return
 
-        for entry in walk(root_path):
-            size = entry.stat().st_size
-
-            if test_mode and size > 50 * MB:
-                continue
+        f.writelines(
+            File(name=path, size=size).to_entry()
+            for path, size in walk_parallel(root_path)
+            if not (test_mode and size > 50 * MB)
+        )
 
-            File(name=entry.path, size=size).write_entry_to(f)
 
+def parse_file_manifest(prefix: Path, file_manifest_path: Path) -> Dict[str, int]:
+    # Compare plain strings; going through Path.parents and Path.relative_to
+    # for every file is far slower and gives the same answer here.
+    prefix_str = str(prefix)
+    prefix_dir = os.path.join(prefix_str, "")
+    prefix_len = len(prefix_dir)
 
-def parse_file_manifest(prefix: Path, file_manifest_path: Path) -> Dict[Path, int]:
     files = {}
-    for entry, _ in read_manifest(file_manifest_path):
-        entry = check_entry_type(entry, File)
+    for (type, info), _ in read_manifest_info(file_manifest_path):
+        if type != File.type:
+            raise InvalidManifestEntry("Expected a {}, but got a {}".format(File.type, type))
 
-        fname = entry.name
-        size = entry.size
+        fname = info["name"]
+        size = int(info["size"])
 
-        if prefix not in fname.parents:
-            logging.error("%s file (%s) does not start with specified prefix", fname)
-        if fname == prefix:
-            logging.warning("%s file, stripped of prefix (%s), is empty", prefix)
+        if fname == prefix_str:
+            logging.warning("%s file, stripped of prefix (%s), is empty", fname, prefix)
             continue
-        files[fname.relative_to(prefix)] = size
+        if not fname.startswith(prefix_dir):
+            logging.error("%s file does not start with specified prefix (%s)", fname, prefix)
+            continue
+        files[fname[prefix_len:]] = size
 
     return files
 
 
-def walk(path):
-    for entry in os.scandir(str(path)):
-        if entry.is_dir():
-            yield from walk(entry.path)
-        elif entry.is_file():
-            yield entry
+def walk_parallel(path, workers: int = WALK_WORKERS) -> Iterator[Tuple[str, int]]:
+    # Listing is mostly waiting on scandir and stat, so list several directories
+    # at once; files come out in no particular order.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(scan_dir, str(path))}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                subdirs, files = future.result()
+                pending.update(pool.submit(scan_dir, d) for d in subdirs)
+                yield from files
+
+
+def scan_dir(path: str) -> Tuple[List[str], List[Tuple[str, int]]]:
+    subdirs = []
+    files = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            # Only symlinks need resolving; anything else is typed by the
+            # directory listing itself and needs at most one lstat for its size.
+            follow = entry.is_symlink()
+            if entry.is_dir(follow_symlinks=follow):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=follow):
+                files.append((entry.path, entry.stat(follow_symlinks=follow).st_size))
+
+    return subdirs, files
 
 
 def write_metadata_file(path: Path, hasher, size: int) -> None:
-    metadata = Metadata(name=path, digest=hasher.hexdigest(), size=size)
+    metadata = MetadataV2(name=path, digest=hasher.hexdigest(), size=size, algorithm=hasher.name)
 
     logging.info("File metadata: {}".format(metadata))
 
-    with Path(METADATA_FILE_NAME).open(mode="w", encoding="utf-8") as f:
-        metadata.write_entry_to(f)
+    fd = os.open(METADATA_FILE_NAME, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        write_all(fd, metadata.to_entry().encode("utf-8"))
+    finally:
+        os.close(fd)
 
     logging.info("Wrote metadata file")
 
 
+def append_entries_durably(path: Path, entries: Iterable[ManifestEntry]) -> None:
+    # Concurrent POST scripts append to the same transfer manifest; an
+    # O_APPEND write keeps each batch of entries together.
+    data = "".join(entry.to_entry() for entry in entries).encode("utf-8")
+
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        write_all(fd, data)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_all(fd: int, data: bytes) -> None:
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
 def read_metadata_file(path: Path) -> Metadata:
     if path.stat().st_size > METADATA_FILE_SIZE_LIMIT:
         raise InvalidManifestEntry("Metadata file is too large")
@@ -379,18 +558,42 @@ def check_entry_type(entry: ManifestEntry, expected_type: Type[T]) -> T:
     return entry
 
 
+def json_dumps(j: Any) -> str:
+    if orjson is None:
+        return json.dumps(j)
+
+    try:
+        return orjson.dumps(j, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    except TypeError:
+        # File names that are not valid UTF-8 come back from the OS with
+        # surrogate escapes, which orjson refuses; json writes them as \udcXX.
+        return json.dumps(j)
+
+
+def json_loads(s) -> Any:
+    if orjson is None:
+        return json.loads(s)
+
+    try:
+        return orjson.loads(s)
+    except orjson.JSONDecodeError:
+        # orjson also refuses the \udcXX escapes json writes for such names.
+        return json.loads(s)
+
+
 def write_json(j: T_JSON, path: Path) -> None:
-    with path.open(mode="w", encoding="utf-8") as f:
-        json.dump(j, f)
+    path.write_text(json_dumps(j), encoding="utf-8")
 
 
 def load_json(path: Path) -> T_JSON:
-    with path.open(mode="r", encoding="utf-8") as f:
-        return json.load(f)
+    return json_loads(path.read_bytes())
 
 
-def make_hasher():
-    return hashlib.sha1()
+def make_hasher(algorithm: str = HASH_ALGORITHM):
+    try:
+        return HASH_ALGORITHMS[algorithm]()
+    except KeyError:
+        raise VerificationFailed("Unknown hash algorithm {}".format(algorithm))
 
 
 def shared_submit_descriptors(
@@ -434,6 +637,7 @@ def submit_outer_dag(
     test_mode: bool = False,
     annex_name: Optional[str] = None,
     dry_run: bool = False,
+    reverify_modified: bool = False,
 ) -> int:
     # Only import htcondor submit-side
     import htcondor
@@ -455,6 +659,7 @@ def submit_outer_dag(
         test_mode=test_mode,
         annex_name=annex_name,
         dry_run=dry_run,
+        reverify_modified=reverify_modified,
     )
 
     outer_dag_file = dags.write_dag(outer_dag, dag_dir=working_dir, dag_file_name=OUTER_DAG_NAME)
@@ -478,6 +683,7 @@ def make_outer_dag(
     test_mode: bool,
     annex_name: Optional[str],
     dry_run: bool,
+    reverify_modified: bool,
 ):
     # Only import htcondor submit-side
     import htcondor
@@ -530,6 +736,7 @@ def make_outer_dag(
                 "--test-mode" if test_mode else "",
                 "--annex-name={}".format(annex_name) if annex_name is not None else "",
                 "--dry-run" if dry_run else "",
+                "--reverify-modified" if reverify_modified else "",
             ],
         ),
     ).child_subdag(
@@ -556,6 +763,7 @@ def write_inner_dag(
     unique_id: Optional[str] = None,
     annex_name: Optional[str] = None,
     dry_run: bool = False,
+    reverify_modified: bool = False,
 ):
     # Only import htcondor submit-side
     import htcondor.dags as dags
@@ -576,45 +784,49 @@ def write_inner_dag(
     transfer_manifest_path.parent.mkdir(parents=True, exist_ok=True)
     transfer_manifest_path.touch(exist_ok=True)
 
-    # Never transfer the transfer manifest
-    transfer_manifest_file = transfer_manifest_path.relative_to(local_prefix)
+    # Never transfer the transfer manifest, or what we know about it (including a
+    # checkpoint left half-written by an interrupted analysis)
+    transfer_manifest_file = str(transfer_manifest_path.relative_to(local_prefix))
+    analyze_state_file = transfer_manifest_file + ANALYZE_STATE_SUFFIX
 
-    local_files.pop(transfer_manifest_file, None)
-    remote_files.pop(transfer_manifest_file, None)
+    for fname in (transfer_manifest_file, analyze_state_file, analyze_state_file + ".tmp"):
+        local_files.pop(fname, None)
+        remote_files.pop(fname, None)
 
     if direction is TransferDirection.PULL:
         src_files, dest_files = remote_files, local_files
     else:  # This is a PUSH
         src_files, dest_files = local_files, remote_files
 
-    files_to_transfer = {
-        fname for fname, size in src_files.items() if size != dest_files.get(fname, -1)
+    # Files missing at the destination, plus files present on both sides whose sizes differ.
+    files_in_both = src_files.keys() & dest_files.keys()
+    files_to_transfer = (src_files.keys() - files_in_both) | {
+        fname for fname in files_in_both if src_files[fname] != dest_files[fname]
     }
 
     # Check for files that we have already verified, and do not verify them again.
-    files_verified = set()
+    files_verified = {}
     for entry, _ in read_manifest(transfer_manifest_path):
         if not isinstance(entry, TransferComplete):
             continue
 
-        files_verified.add(entry.name)
+        files_verified[str(entry.name)] = entry
 
-    # Verify files that already exist at the source and destination.
-    files_to_verify = set()
-    for fname in src_files:
-        if fname in files_to_transfer:
-            continue
+    # Unless the local copy has changed since it was verified.
+    if reverify_modified:
+        files_verified = {
+            fname: entry
+            for fname, entry in files_verified.items()
+            if unchanged_since_verified(local_prefix / fname, entry)
+        }
 
-        if fname in dest_files and fname not in files_verified:
-            files_to_verify.add(fname)
+    # Verify files that already exist at the source and destination.
+    files_to_verify = files_in_both - files_to_transfer - files_verified.keys()
 
     files_to_transfer = sorted(files_to_transfer)
     files_to_verify = sorted(files_to_verify)
 
     if dry_run:
-        files_to_transfer = [os.fspath(p) for p in files_to_transfer]
-        files_to_verify = [os.fspath(p) for p in files_to_verify]
-
         with Path(DRY_RUN_OUTPUT_FILE_NAME).open(mode="w", encoding="utf-8") as f:
             json.dump(
                 {
@@ -659,7 +871,9 @@ def write_inner_dag(
     bytes_to_transfer = sum(src_files[fname] for fname in files_to_transfer)
     bytes_to_verify = sum(src_files[fname] for fname in files_to_verify)
 
-    with transfer_manifest_path.open(mode="a", encoding="utf-8") as f:
+    with transfer_manifest_path.open(
+        mode="a", encoding="utf-8", buffering=MANIFEST_BUFFER_SIZE
+    ) as f:
         SyncRequestV2(
             direction=direction,
             remote_prefix=remote_prefix,
@@ -672,11 +886,26 @@ def write_inner_dag(
             dry_run=dry_run,
         ).write_entry_to(f)
 
-        for fname in files_to_transfer:
-            TransferRequest(name=fname, size=src_files[fname]).write_entry_to(f)
+        f.writelines(
+            TransferRequest(name=fname, size=src_files[fname]).to_entry()
+            for fname in files_to_transfer
+        )
+        f.writelines(
+            VerifyRequest(name=fname, size=src_files[fname]).to_entry() for fname in files_to_verify
+        )
+
+
+def unchanged_since_verified(path: Path, entry: TransferComplete) -> bool:
+    # Entries written before mtimes were recorded cannot tell us anything.
+    if entry.mtime is None:
+        return True
+
+    try:
+        path_stat = path.stat()
+    except FileNotFoundError:
+        return False
 
-        for fname in files_to_verify:
-            VerifyRequest(name=fname, size=src_files[fname]).write_entry_to(f)
+    return path_stat.st_size == entry.size and path_stat.st_mtime == entry.mtime
 
 
 def make_inner_dag(
@@ -789,7 +1018,7 @@ def change_dir(dir):
     os.chdir(original)
 
 
-def ensure_local_dirs_exist(prefix: Path, relative_paths: Iterable[Path]) -> None:
+def ensure_local_dirs_exist(prefix: Path, relative_paths: Iterable[str]) -> None:
     for d in {(prefix / relative_path).parent for relative_path in relative_paths}:
         d.mkdir(exist_ok=True, parents=True)
 
@@ -802,7 +1031,7 @@ def make_cmd_info(
     for fname in files:
         remote_file = remote_prefix / fname
         local_file = local_prefix / fname
-        flattened_name = flatten_path(fname)
+        flattened_name = flatten_path(Path(fname))
 
         info = {
             "direction": direction,
@@ -873,12 +1102,13 @@ def post_transfer(
     remote_name = entry.name
     remote_digest = entry.digest
     remote_size = entry.size
+    algorithm = entry.algorithm
 
     if direction is TransferDirection.PULL and not only_verify:
         local_target = flattened_name
     else:
         local_target = local_name
-    verify_metadata(local_target, remote_digest, remote_name, remote_size)
+    verify_metadata(local_target, remote_digest, remote_name, remote_size, algorithm)
 
     if direction is TransferDirection.PULL and not only_verify:
         logging.info(
@@ -888,19 +1118,12 @@ def post_transfer(
             flattened_name.rename(local_name)
         else:
             shutil.copy2(str(flattened_name), str(local_name))
-            verify_metadata(local_name, remote_digest, remote_name, remote_size)
+            verify_metadata(local_name, remote_digest, remote_name, remote_size, algorithm)
             flattened_name.unlink()
 
-    with transfer_manifest_path.open(mode="a", encoding="utf-8") as f:
-        TransferComplete(
-            name=local_name.relative_to(local_prefix),
-            digest=remote_digest,
-            size=remote_size,
-            timestamp=timestamp(),
-        ).write_entry_to(f)
-
-        f.flush()
-        os.fsync(f.fileno())
+    append_entries_durably(
+        transfer_manifest_path, [make_transfer_complete(local_prefix, local_name, entry)]
+    )
 
     for path in (
         metadata_path,
@@ -912,7 +1135,26 @@ def post_transfer(
             path.unlink()
 
 
-def verify_metadata(local_path: Path, remote_digest, remote_path: Path, remote_size: int):
+def make_transfer_complete(
+    local_prefix: Path, local_name: Path, metadata: Metadata
+) -> TransferCompleteV2:
+    return TransferCompleteV2(
+        name=local_name.relative_to(local_prefix),
+        digest=metadata.digest,
+        size=metadata.size,
+        timestamp=timestamp(),
+        algorithm=metadata.algorithm,
+        mtime=local_name.stat().st_mtime,
+    )
+
+
+def verify_metadata(
+    local_path: Path,
+    remote_digest,
+    remote_path: Path,
+    remote_size: int,
+    algorithm: str = HASH_ALGORITHM,
+):
     local_size = local_path.stat().st_size
     if remote_size != local_size:
         raise VerificationFailed(
@@ -921,7 +1163,10 @@ def verify_metadata(local_path: Path, remote_digest, remote_path: Path, remote_s
             )
         )
 
-    hasher, byte_count = hash_file(local_path)
+    # Verification happens on the AP, and the file is not read again after it is
+    # verified, so don't let it push more useful data out of the page cache. On
+    # the EP (get_remote_metadata) the file may be shared data other jobs still want.
+    hasher, byte_count = hash_file(local_path, algorithm=algorithm, drop_cache=True)
     local_digest = hasher.hexdigest()
     if remote_digest != local_digest:
         raise VerificationFailed(
@@ -952,14 +1197,14 @@ def copy_with_hash(src_path: Path, dest_path: Path) -> Tuple[Any, int]:
     tmp_path.parent.mkdir(parents=True, exist_ok=True)
 
     with src_path.open(mode="rb") as src, tmp_path.open(mode="wb") as dest:
-        buf = src.read(MB)
-        byte_count = len(buf)
+        byte_count = 0
+
+        fadvise(src.fileno(), "POSIX_FADV_SEQUENTIAL")
 
-        while len(buf) > 0:
+        for buf in read_chunks(src, size):
             hasher.update(buf)
             dest.write(buf)
-
-            buf = src.read(MB)
+            byte_count += len(buf)
 
             now = time.time()
             if now - last_log > 5:
@@ -971,8 +1216,6 @@ def copy_with_hash(src_path: Path, dest_path: Path) -> Tuple[Any, int]:
                 )
                 last_log = now
 
-            byte_count += len(buf)
-
         logging.info("Copy complete; about to synchronize file to disk")
 
         dest.flush()
@@ -996,7 +1239,9 @@ def copy_with_hash(src_path: Path, dest_path: Path) -> Tuple[Any, int]:
     return hasher, byte_count
 
 
-def hash_file(path: Path) -> Tuple[Any, int]:
+def hash_file(
+    path: Path, algorithm: str = HASH_ALGORITHM, drop_cache: bool = False
+) -> Tuple[Any, int]:
     logging.info("About to hash %s", path)
 
     size = path.stat().st_size
@@ -1004,15 +1249,16 @@ def hash_file(path: Path) -> Tuple[Any, int]:
     logging.info("There are %.2f MB to hash", size / MB)
     last_log = time.time()
 
-    hasher = make_hasher()
+    hasher = make_hasher(algorithm)
 
     with path.open(mode="rb") as f:
-        buf = f.read(MB)
-        byte_count = len(buf)
+        byte_count = 0
+
+        fadvise(f.fileno(), "POSIX_FADV_SEQUENTIAL")
 
-        while len(buf) > 0:
+        for buf in read_chunks(f, size):
             hasher.update(buf)
-            buf = f.read(MB)
+            byte_count += len(buf)
 
             now = time.time()
             if now - last_log > 5:
@@ -1024,19 +1270,122 @@ def hash_file(path: Path) -> Tuple[Any, int]:
                 )
                 last_log = now
 
-            byte_count += len(buf)
+        if drop_cache:
+            fadvise(f.fileno(), "POSIX_FADV_DONTNEED")
 
     return hasher, byte_count
 
 
-def analyze(transfer_manifest_path: Path) -> None:
-    sync_request_start = None
-    sync_request = {"files": {}, "transfer_files": set(), "verified_files": {}}
-    local_dir = transfer_manifest_path.parent.resolve()
-    sync_count = 0
-    mismatched_filesizes = {}
+def io_chunk_size(size: int) -> int:
+    # Don't allocate read buffers much larger than the file being read.
+    return min(IO_CHUNK_SIZE, max(size, 64 * KB))
+
+
+def fadvise(fd: int, advice: str) -> None:
+    # posix_fadvise only exists on some platforms, and is only a hint anyway.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+
+
+def read_chunks(f, size: int) -> Iterator[memoryview]:
+    # Chunks are views into reused buffers, valid until the next one is requested.
+    chunk_size = io_chunk_size(size)
 
-    for entry, line_number in read_manifest(transfer_manifest_path):
+    # A file that fits in a single chunk leaves nothing to overlap, so don't
+    # start a thread or allocate read-ahead buffers for it.
+    if size <= chunk_size:
+        buf = memoryview(bytearray(chunk_size))
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                return
+
+            yield buf if n == len(buf) else buf[:n]
+
+    # Read larger files ahead on a thread, overlapping reads with the caller's work.
+    # The buffers are passed around as views so that neither side has to
+    # create a new view of a buffer for every chunk.
+    filled: queue.Queue = queue.Queue()
+    empty: queue.Queue = queue.Queue()
+
+    def read():
+        allocated = 0
+        try:
+            while True:
+                # Only allocate another buffer when the reader gets ahead of the consumer.
+                try:
+                    buf = empty.get_nowait()
+                except queue.Empty:
+                    if allocated < READ_AHEAD_BUFFERS:
+                        buf = memoryview(bytearray(chunk_size))
+                        allocated += 1
+                    else:
+                        buf = empty.get()
+                if buf is None:
+                    return
+
+                n = f.readinto(buf)
+                if not n:
+                    break
+
+                filled.put((buf, n))
+
+            filled.put(None)
+        except Exception as e:
+            filled.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+
+    try:
+        while True:
+            item = filled.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+
+            buf, n = item
+            yield buf if n == len(buf) else buf[:n]
+            empty.put(buf)
+    finally:
+        # Wake the reader if it is waiting for a buffer we will never return.
+        empty.put(None)
+        reader.join()
+
+
+def analyze(transfer_manifest_path: Path, from_scratch: bool = False) -> None:
+    local_dir = transfer_manifest_path.parent.resolve()
+    state_path = analyze_state_path(transfer_manifest_path)
+    manifest_stat = transfer_manifest_path.stat()
+
+    # Pick up where the last analysis of this manifest left off, if we can.
+    state = (
+        None
+        if from_scratch
+        else load_analyze_state(state_path, transfer_manifest_path, manifest_stat)
+    )
+    if state is None:
+        state = new_analyze_state()
+
+    sync_request_start = state["sync_request_start"]
+    sync_request = state["sync_request"]
+    sync_count = state["sync_count"]
+    # The size and line number of the latest verification of each file; the
+    # files on disk are checked against these once the whole log has been read.
+    verified_sizes: Dict[Path, Tuple[int, int]] = state["verified_sizes"]
+
+    with transfer_manifest_path.open(mode="rb") as f:
+        f.seek(state["offset"])
+        data = f.read()
+
+    # Leave any partially written entry for next time.
+    if not data.endswith(b"\n"):
+        data = data[: data.rfind(b"\n") + 1]
+
+    for entry, line_number in parse_manifest_lines(
+        transfer_manifest_path, data, parse_manifest_entry, state["line_number"]
+    ):
         if isinstance(entry, SyncRequest):
             sync_count += 1
             # if sync_request_start is not None:
@@ -1088,15 +1437,7 @@ def analyze(transfer_manifest_path: Path) -> None:
                     ),
                 )
 
-            local_size = (local_dir / fname).stat().st_size
-            if local_size != size:
-                mismatched_filesizes[fname] = {
-                    "expected": size,
-                    "got": local_size,
-                    "line_number": line_number,
-                }
-            else:
-                mismatched_filesizes.pop(fname, None)
+            verified_sizes[fname] = (size, line_number)
 
             if fname in sync_request["transfer_files"]:
                 sync_request["files_to_transfer"] -= 1
@@ -1116,13 +1457,7 @@ def analyze(transfer_manifest_path: Path) -> None:
                     )
                 )
 
-            if (
-                sync_request["files_to_verify"]
-                or sync_request["bytes_to_verify"]
-                or sync_request["files"]
-                or sync_request["files_to_transfer"]
-                or sync_request["bytes_to_transfer"]
-            ):
+            if any(sync_request[key] for key in WORK_REMAINING_KEYS):
                 raise InconsistentManifest(
                     "SYNC_DONE but there is work remaining: {}".format(sync_request)
                 )
@@ -1130,26 +1465,38 @@ def analyze(transfer_manifest_path: Path) -> None:
             sync_request_start = None
             sync_request = {"files": {}, "transfer_files": set(), "verified_files": {}}
 
+    offset = state["offset"] + len(data)
+    save_analyze_state(
+        state_path,
+        inode=manifest_stat.st_ino,
+        fingerprint=manifest_fingerprint(transfer_manifest_path, offset),
+        offset=offset,
+        line_number=state["line_number"] + data.count(b"\n"),
+        sync_request_start=sync_request_start,
+        sync_request=sync_request,
+        sync_count=sync_count,
+        verified_sizes=verified_sizes,
+    )
+
+    mismatched_filesizes = find_mismatched_filesizes(local_dir, verified_sizes)
+
     if len(mismatched_filesizes) > 0:
-        for fname, size in mismatched_filesizes.items():
-            logging.error(
-                "- Mismatched file size for %s (line %d): expected %d, got %d on disk",
-                fname,
-                size["line_number"],
-                size["expected"],
-                size["got"],
-            )
+        logging.error(
+            "Mismatched file sizes:\n%s",
+            "\n".join(
+                "- Mismatched file size for {} (line {}): expected {}, got {} on disk".format(
+                    fname, size["line_number"], size["expected"], size["got"]
+                )
+                for fname, size in mismatched_filesizes.items()
+            ),
+        )
         raise InconsistentManifest(
-            "Local sizes of {} files did match anticipated sizes.".format(len(mismatched_filesizes))
+            "Local sizes of {} files did not match anticipated sizes.".format(
+                len(mismatched_filesizes)
+            )
         )
 
-    if sync_request_start is not None and (
-        sync_request["files_to_verify"]
-        or sync_request["bytes_to_verify"]
-        or sync_request["files"]
-        or sync_request["files_to_transfer"]
-        or sync_request["bytes_to_transfer"]
-    ):
+    if sync_request_start is not None and any(sync_request[key] for key in WORK_REMAINING_KEYS):
         logging.error("Sync not done! Work remaining.")
         logging.error(
             "- Files to transfer: %s (bytes %d)",
@@ -1161,12 +1508,15 @@ def analyze(transfer_manifest_path: Path) -> None:
             sync_request["files_to_verify"],
             sync_request["bytes_to_verify"],
         )
-        logging.error("Inconsistent files: {}".format(sync_request["files"]))
+        logging.error(
+            "Inconsistent files (%d): %s",
+            len(sync_request["files"]),
+            short_repr(sync_request["files"]),
+        )
         raise InconsistentManifest("There was work remaining!")
 
     if sync_request_start is not None:
-        with transfer_manifest_path.open(mode="a", encoding="utf-8") as f:
-            SyncDone(timestamp=timestamp()).write_entry_to(f)
+        append_entries_durably(transfer_manifest_path, [SyncDone(timestamp=timestamp())])
         print("Synchronization done; verification complete.")
     elif sync_count > 0:
         print("All synchronizations done; verification complete")
@@ -1174,10 +1524,150 @@ def analyze(transfer_manifest_path: Path) -> None:
         raise InconsistentManifest("No synchronization found in manifest.")
 
 
+def analyze_state_path(transfer_manifest_path: Path) -> Path:
+    return transfer_manifest_path.with_name(transfer_manifest_path.name + ANALYZE_STATE_SUFFIX)
+
+
+def new_analyze_state() -> Dict[str, Any]:
+    return {
+        "offset": 0,
+        "line_number": 1,
+        "sync_request_start": None,
+        "sync_request": {"files": {}, "transfer_files": set(), "verified_files": {}},
+        "sync_count": 0,
+        "verified_sizes": {},
+    }
+
+
+def load_analyze_state(
+    state_path: Path, manifest_path: Path, manifest_stat: os.stat_result
+) -> Optional[Dict[str, Any]]:
+    if not state_path.exists():
+        return None
+
+    try:
+        j = load_json(state_path)
+
+        # The manifest is only ever appended to; anything else means it was replaced.
+        # A replacement can reuse the inode, so also check the analyzed content is unchanged.
+        if (
+            j["inode"] != manifest_stat.st_ino
+            or j["offset"] > manifest_stat.st_size
+            or j.get("fingerprint") != manifest_fingerprint(manifest_path, j["offset"])
+        ):
+            logging.info("Transfer manifest has changed since it was last analyzed")
+            return None
+
+        sync_request = j["sync_request"]
+        sync_request["files"] = {Path(k): v for k, v in sync_request["files"].items()}
+        sync_request["transfer_files"] = {Path(k) for k in sync_request["transfer_files"]}
+        sync_request["verified_files"] = {
+            Path(k): v for k, v in sync_request["verified_files"].items()
+        }
+
+        return {
+            "offset": j["offset"],
+            "line_number": j["line_number"],
+            "sync_request_start": j["sync_request_start"],
+            "sync_request": sync_request,
+            "sync_count": j["sync_count"],
+            "verified_sizes": {Path(k): tuple(v) for k, v in j["verified_sizes"].items()},
+        }
+    except Exception:
+        logging.exception("Could not load analysis state from %s; starting over", state_path)
+        return None
+
+
+def save_analyze_state(
+    state_path: Path,
+    inode: int,
+    fingerprint: str,
+    offset: int,
+    line_number: int,
+    sync_request_start: Optional[int],
+    sync_request: Dict[str, Any],
+    sync_count: int,
+    verified_sizes: Mapping[Path, Tuple[int, int]],
+) -> None:
+    sync_request = path_values_to_strings(sync_request)
+    sync_request["files"] = {str(k): v for k, v in sync_request["files"].items()}
+    sync_request["transfer_files"] = [str(k) for k in sync_request["transfer_files"]]
+    sync_request["verified_files"] = {str(k): v for k, v in sync_request["verified_files"].items()}
+
+    tmp_path = state_path.with_name(state_path.name + ".tmp")
+    write_json(
+        {
+            "inode": inode,
+            "fingerprint": fingerprint,
+            "offset": offset,
+            "line_number": line_number,
+            "sync_request_start": sync_request_start,
+            "sync_request": sync_request,
+            "sync_count": sync_count,
+            "verified_sizes": {str(k): list(v) for k, v in verified_sizes.items()},
+        },
+        tmp_path,
+    )
+    tmp_path.replace(state_path)
+
+
+def manifest_fingerprint(path: Path, offset: int) -> str:
+    # Hash the start of the manifest (its first sync request has a timestamp) and
+    # the entries just before the offset, without rereading everything in between.
+    with path.open(mode="rb") as f:
+        head = f.read(min(offset, ANALYZE_FINGERPRINT_SIZE))
+        tail_start = max(0, offset - ANALYZE_FINGERPRINT_SIZE)
+        f.seek(tail_start)
+        tail = f.read(offset - tail_start)
+
+    return hashlib.blake2b(head + tail).hexdigest()
+
+
+def find_mismatched_filesizes(
+    local_dir: Path, verified_sizes: Mapping[Path, Tuple[int, int]]
+) -> Dict[Path, Dict[str, int]]:
+    fnames = list(verified_sizes)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=STAT_WORKERS) as pool:
+        local_sizes = pool.map(lambda fname: (local_dir / fname).stat().st_size, fnames)
+
+        mismatched_filesizes = {}
+        for fname, local_size in zip(fnames, local_sizes):
+            size, line_number = verified_sizes[fname]
+            if local_size != size:
+                mismatched_filesizes[fname] = {
+                    "expected": size,
+                    "got": local_size,
+                    "line_number": line_number,
+                }
+
+    return mismatched_filesizes
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers(dest="cmd")
+    subparsers.required = True
+
+    # Every run only executes one command (most of them once per file, as DAG
+    # nodes), so only set up the parser for that command. Set up all of them
+    # if there is no recognizable command, so that help and usage errors list
+    # every command.
+    name = sys.argv[1] if len(sys.argv) > 1 else None
+    commands = [COMMANDS_BY_NAME[name]] if name in COMMANDS_BY_NAME else list(Commands)
+
+    for command in commands:
+        COMMAND_PARSERS[command](subparsers)
+
+    args = parser.parse_args()
+
+    # Parsing only succeeds for a known command, which we already looked up above
+    args.cmd = commands[0]
+
+    return args
 
+
+def add_sync_parser(subparsers) -> None:
     sync = subparsers.add_parser(Commands.SYNC)
     sync.add_argument("direction", type=TransferDirection)
     sync.add_argument("local", type=Path)
@@ -1194,11 +1684,16 @@ def parse_args():
     add_test_mode_arg(sync)
     add_annex_name_arg(sync)
     add_dry_run_arg(sync)
+    add_reverify_modified_arg(sync)
+
 
+def add_make_remote_file_manifest_parser(subparsers) -> None:
     make_remote_file_manifest = subparsers.add_parser(Commands.MAKE_REMOTE_FILE_MANIFEST)
     make_remote_file_manifest.add_argument("src", type=Path)
     add_test_mode_arg(make_remote_file_manifest)
 
+
+def add_write_inner_dag_parser(subparsers) -> None:
     write_inner_dag = subparsers.add_parser(Commands.WRITE_INNER_DAG)
     write_inner_dag.add_argument(
         "direction", type=TransferDirection, choices=list(TransferDirection)
@@ -1211,29 +1706,51 @@ def parse_args():
     add_test_mode_arg(write_inner_dag)
     add_annex_name_arg(write_inner_dag)
     add_dry_run_arg(write_inner_dag)
+    add_reverify_modified_arg(write_inner_dag)
 
+
+def add_pull_file_parser(subparsers) -> None:
     pull_file = subparsers.add_parser(Commands.PULL_FILE)
     pull_file.add_argument("src", type=Path)
 
+
+def add_push_file_parser(subparsers) -> None:
     push_file = subparsers.add_parser(Commands.PUSH_FILE)
     push_file.add_argument("dest", type=Path)
 
+
+def add_get_remote_metadata_parser(subparsers) -> None:
     get_remote_metadata = subparsers.add_parser(Commands.GET_REMOTE_METADATA)
     get_remote_metadata.add_argument("src", type=Path)
 
+
+def add_post_transfer_parser(subparsers) -> None:
     post_transfer = subparsers.add_parser(Commands.POST_TRANSFER)
     post_transfer.add_argument("--cmd-info", type=Path)
     post_transfer.add_argument("--key")
     post_transfer.add_argument("--only-verify", action="store_true")
 
+
+def add_finalize_transfer_manifest_parser(subparsers) -> None:
     analyze = subparsers.add_parser(Commands.FINALIZE_TRANSFER_MANIFEST)
     analyze.add_argument("transfer_manifest", type=Path)
+    analyze.add_argument(
+        "--from-scratch",
+        help="Reanalyze the whole transfer manifest instead of resuming the last analysis",
+        action="store_true",
+    )
 
-    args = parser.parse_args()
-
-    args.cmd = Commands(args.cmd)
 
-    return args
+COMMAND_PARSERS = {
+    Commands.SYNC: add_sync_parser,
+    Commands.MAKE_REMOTE_FILE_MANIFEST: add_make_remote_file_manifest_parser,
+    Commands.WRITE_INNER_DAG: add_write_inner_dag_parser,
+    Commands.PULL_FILE: add_pull_file_parser,
+    Commands.PUSH_FILE: add_push_file_parser,
+    Commands.GET_REMOTE_METADATA: add_get_remote_metadata_parser,
+    Commands.POST_TRANSFER: add_post_transfer_parser,
+    Commands.FINALIZE_TRANSFER_MANIFEST: add_finalize_transfer_manifest_parser,
+}
 
 
 def add_test_mode_arg(parser: argparse.ArgumentParser) -> None:
@@ -1270,101 +1787,162 @@ def add_dry_run_arg(parser: argparse.ArgumentParser):
     )
 
 
+def add_reverify_modified_arg(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--reverify-modified",
+        help="Verify previously verified files again if their size or modification time changed",
+        action="store_true",
+    )
+
+
 def main():
     args = parse_args()
 
-    logging.debug(
-        "{} called with args:\n\t{}".format(
-            sys.argv[0], "\n\t".join("{} = {!r}".format(k, v) for k, v in vars(args).items())
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(
+            "%s called with args:\n\t%s",
+            sys.argv[0],
+            "\n\t".join("{} = {!r}".format(k, v) for k, v in vars(args).items()),
         )
+
+    if args.cmd in NEEDS_JOB_AD:
+        check_running_as_job()
+
+    COMMAND_HANDLERS[args.cmd](args)
+
+
+def do_sync(args: argparse.Namespace) -> None:
+    check_already_running(args.unique_id)
+
+    cluster_id = submit_outer_dag(
+        direction=args.direction,
+        working_dir=args.working_dir,
+        local_dir=args.local,
+        remote_dir=args.remote,
+        requirements=read_requirements_file(args.requirements_file) or args.requirements,
+        unique_id=args.unique_id,
+        test_mode=args.test_mode,
+        annex_name=args.annex_name,
+        dry_run=args.dry_run,
+        reverify_modified=args.reverify_modified,
     )
 
-    if args.cmd is Commands.SYNC:
-        check_already_running(args.unique_id)
-
-        cluster_id = submit_outer_dag(
-            direction=args.direction,
-            working_dir=args.working_dir,
-            local_dir=args.local,
-            remote_dir=args.remote,
-            requirements=read_requirements_file(args.requirements_file) or args.requirements,
-            unique_id=args.unique_id,
-            test_mode=args.test_mode,
-            annex_name=args.annex_name,
-            dry_run=args.dry_run,
-        )
+    print("Outer DAG is running in cluster {}".format(cluster_id))
 
-        print("Outer DAG is running in cluster {}".format(cluster_id))
-    elif args.cmd is Commands.MAKE_REMOTE_FILE_MANIFEST:
-        check_running_as_job()
-        create_file_manifest(args.src, Path(REMOTE_MANIFEST_FILE_NAME), test_mode=args.test_mode)
-    elif args.cmd is Commands.WRITE_INNER_DAG:
-        write_inner_dag(
-            direction=args.direction,
-            remote_prefix=args.remote_prefix,
-            remote_manifest=args.remote_manifest,
-            local_prefix=args.local_prefix,
-            requirements=read_requirements_file(args.requirements_file) or args.requirements,
-            test_mode=args.test_mode,
-            unique_id=args.unique_id,
-            annex_name=args.annex_name,
-            dry_run=args.dry_run,
-        )
-    elif args.cmd is Commands.PULL_FILE:
-        check_running_as_job()
-        pull_file(path=args.src)
-    elif args.cmd is Commands.PUSH_FILE:
-        check_running_as_job()
-        push_file(path=args.dest)
-    elif args.cmd is Commands.GET_REMOTE_METADATA:
-        check_running_as_job()
-        get_remote_metadata(path=args.src)
-    elif args.cmd is Commands.POST_TRANSFER:
-        cmd_info_path = load_json(args.cmd_info)
-        # Split the DAG job name (which is passed as fileid) to get the cmd_info key
-        info = cmd_info_path[args.key.split(":")[-1]]
-        post_transfer(
-            direction=TransferDirection(info["direction"]),
-            local_prefix=Path(info["local_prefix"]),
-            local_name=Path(info["local_file"]).resolve(),
-            flattened_name=Path(info["flattened_name"]).resolve(),
-            metadata_path=Path("{}.metadata".format(info["flattened_name"])).resolve(),
-            transfer_manifest_path=Path(info["transfer_manifest"]),
-            only_verify=args.only_verify,
-        )
-    elif args.cmd is Commands.FINALIZE_TRANSFER_MANIFEST:
-        analyze(args.transfer_manifest)
+
+def do_make_remote_file_manifest(args: argparse.Namespace) -> None:
+    create_file_manifest(args.src, Path(REMOTE_MANIFEST_FILE_NAME), test_mode=args.test_mode)
+
+
+def do_write_inner_dag(args: argparse.Namespace) -> None:
+    write_inner_dag(
+        direction=args.direction,
+        remote_prefix=args.remote_prefix,
+        remote_manifest=args.remote_manifest,
+        local_prefix=args.local_prefix,
+        requirements=read_requirements_file(args.requirements_file) or args.requirements,
+        test_mode=args.test_mode,
+        unique_id=args.unique_id,
+        annex_name=args.annex_name,
+        dry_run=args.dry_run,
+        reverify_modified=args.reverify_modified,
+    )
+
+
+def do_pull_file(args: argparse.Namespace) -> None:
+    pull_file(path=args.src)
+
+
+def do_push_file(args: argparse.Namespace) -> None:
+    push_file(path=args.dest)
+
+
+def do_get_remote_metadata(args: argparse.Namespace) -> None:
+    get_remote_metadata(path=args.src)
+
+
+def do_post_transfer(args: argparse.Namespace) -> None:
+    cmd_info_path = load_json(args.cmd_info)
+    # Split the DAG job name (which is passed as fileid) to get the cmd_info key
+    _, _, fileid = args.key.rpartition(":")
+    info = cmd_info_path[fileid]
+    post_transfer(
+        direction=TransferDirection(info["direction"]),
+        local_prefix=Path(info["local_prefix"]),
+        local_name=Path(info["local_file"]).resolve(),
+        flattened_name=Path(info["flattened_name"]).resolve(),
+        metadata_path=Path("{}.metadata".format(info["flattened_name"])).resolve(),
+        transfer_manifest_path=Path(info["transfer_manifest"]),
+        only_verify=args.only_verify,
+    )
+
+
+def do_finalize_transfer_manifest(args: argparse.Namespace) -> None:
+    analyze(args.transfer_manifest, from_scratch=args.from_scratch)
+
+
+COMMAND_HANDLERS = {
+    Commands.SYNC: do_sync,
+    Commands.MAKE_REMOTE_FILE_MANIFEST: do_make_remote_file_manifest,
+    Commands.WRITE_INNER_DAG: do_write_inner_dag,
+    Commands.PULL_FILE: do_pull_file,
+    Commands.PUSH_FILE: do_push_file,
+    Commands.GET_REMOTE_METADATA: do_get_remote_metadata,
+    Commands.POST_TRANSFER: do_post_transfer,
+    Commands.FINALIZE_TRANSFER_MANIFEST: do_finalize_transfer_manifest,
+}
+
+# Commands that only make sense inside an HTCondor job, on the EP
+NEEDS_JOB_AD = frozenset(
+    {
+        Commands.MAKE_REMOTE_FILE_MANIFEST,
+        Commands.PULL_FILE,
+        Commands.PUSH_FILE,
+        Commands.GET_REMOTE_METADATA,
+    }
+)
 
 
 def check_already_running(unique_id: Optional[str]) -> None:
-    # Only import htcondor submit-side
+    if not unique_id:
+        return
+
+    # Only import htcondor submit-side, and only when there is something to look up
     import classad
     import htcondor
 
-    if not unique_id:
-        return
+    constraint = classad.ExprTree(
+        "UniqueId == {} && JobStatus =!= 4".format(classad.quote(unique_id))
+    )
 
+    # We only care whether any job matches, so ask the schedd for at most one ad
+    # and none of its attributes
     schedd = htcondor.Schedd()
-    existing_job = schedd.query(
-        constraint="UniqueId == {} && JobStatus =!= 4".format(classad.quote(unique_id)),
-        projection=[],
-        limit=1,
-    )
-    if len(existing_job) > 0:
+    existing_job = schedd.query(constraint=constraint, projection=[], limit=1)
+    if existing_job:
         raise TransferAlreadyRunning(
             'Jobs already found in queue with UniqueId == "{}"'.format(unique_id)
         )
 
 
 def check_running_as_job() -> None:
-    if "_CONDOR_JOB_AD" not in os.environ:
+    if not IS_CONDOR_JOB:
         raise NotACondorJob("This step must be run as an HTCondor job.")
 
 
 if __name__ == "__main__":
     try:
-        logging.basicConfig(format="%(asctime)s ~ %(message)s", level=logging.DEBUG)
+        logging.basicConfig(
+            format="%(asctime)s ~ %(message)s",
+            level=logging.DEBUG if os.environ.get("HTCONDOR_FT_DEBUG") else logging.INFO,
+        )
         main()
     except Exception as e:
-        logging.exception("Error: {}".format(e))
-        sys.exit(1)
+        logging.exception("Error: %s", e)
+        # Exit without running interpreter teardown (atexit handlers, binding
+        # destructors), which only delays the DAG node; os._exit skips
+        # flushing, so do that ourselves first.
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(1)